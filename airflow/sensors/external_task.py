@@ -17,19 +17,217 @@
 # under the License.
 
 import datetime
+import functools
+import logging
+import operator
 import os
-from typing import TYPE_CHECKING, Any, Callable, Collection, FrozenSet, Iterable, Optional, Union
-
-from sqlalchemy import func
-
-from airflow.exceptions import AirflowException
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NoReturn,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import pendulum
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import join
+
+from airflow.exceptions import AirflowException, AirflowSensorTimeout, AirflowSkipException
 from airflow.models import BaseOperatorLink, DagBag, DagModel, DagRun, TaskInstance
+from airflow.models.taskreschedule import TaskReschedule
 from airflow.operators.dummy import DummyOperator
 from airflow.sensors.base import BaseSensorOperator
+from airflow.triggers.external_task import ExternalTaskTrigger
+from airflow.utils import timezone
+from airflow.utils.context import Context
 from airflow.utils.helpers import build_airflow_url_with_query
 from airflow.utils.session import provide_session
 from airflow.utils.state import State
 
+if TYPE_CHECKING:
+    from airflow.models.dag import DAG
+
+_TASK_STATES = frozenset(State.task_states)
+_DAG_STATES = frozenset(State.dag_states)
+_DEFAULT_ALLOWED_STATES = (State.SUCCESS,)
+
+# ExternalTaskMarker execution_date converters to str, looked up by exact type
+_EXECUTION_DATE_CONVERTERS: Dict[type, Callable[[Any], str]] = {
+    str: lambda execution_date: execution_date,
+    datetime.datetime: operator.methodcaller("isoformat"),
+    pendulum.DateTime: operator.methodcaller("isoformat"),
+}
+
+# Context keys not forwarded to execution_date_fn as keyword arguments
+_EXECUTION_DATE_FN_EXCLUDED_KEYS = frozenset({"execution_date", "logical_date"})
+
+# DagModel.fileloc lookups are shared by all sensor instances of the process, keyed by dag_id
+_DAG_FILELOC_CACHE_TTL = 300
+_DAG_FILELOC_CACHE_MAXSIZE = 1024
+_dag_fileloc_cache: Dict[str, Tuple[float, str]] = {}
+
+
+def _get_dag_fileloc(dag_id: str, session) -> Optional[str]:
+    """Return the fileloc of ``dag_id`` from DagModel, or None if the DAG does not exist."""
+    now = time.monotonic()
+    cached = _dag_fileloc_cache.get(dag_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    fileloc = session.query(DagModel.fileloc).filter(DagModel.dag_id == dag_id).scalar()
+    if fileloc is not None:
+        if len(_dag_fileloc_cache) >= _DAG_FILELOC_CACHE_MAXSIZE:
+            _dag_fileloc_cache.clear()
+        _dag_fileloc_cache[dag_id] = (now + _DAG_FILELOC_CACHE_TTL, fileloc)
+    return fileloc
+
+
+_FILELOC_EXISTS_CACHE_TTL = 60
+
+
+@functools.lru_cache(maxsize=4096)
+def _fileloc_exists(fileloc: str, time_bucket: int) -> bool:
+    """
+    Cached ``os.path.exists``, which can block for a while on network file systems.
+
+    ``time_bucket`` is only part of the cache key, so that the result expires when it changes.
+    """
+    return os.path.exists(fileloc)
+
+
+# Only a fallback for DAGs missing from serialized_dag; keep few parsed DAGs alive
+@functools.lru_cache(maxsize=16)
+def _load_external_dag(fileloc: str, mtime: float, dag_id: str) -> Optional["DAG"]:
+    """
+    Parse ``fileloc`` and return ``dag_id`` from it.
+
+    ``mtime`` is only part of the cache key, so that the file is parsed again once it changes.
+    """
+    return DagBag(fileloc).get_dag(dag_id)
+
+
+def _get_external_dag(dag_id: str, fileloc: str, session) -> Optional["DAG"]:
+    """
+    Return ``dag_id`` from its serialized representation, only parsing ``fileloc``
+    when the DAG has not been serialized.
+    """
+    from airflow.models.serialized_dag import SerializedDagModel
+
+    serialized_dag = SerializedDagModel.get(dag_id, session=session)
+    if serialized_dag:
+        dag = serialized_dag.dag
+        # The root DAG is returned when dag_id is a subdag
+        if dag.dag_id == dag_id:
+            return dag
+    try:
+        mtime = os.stat(fileloc).st_mtime
+    except FileNotFoundError:
+        # The existence check is cached, so the file may have gone since
+        raise AirflowException(f'The external DAG {dag_id} was deleted.')
+    return _load_external_dag(fileloc, mtime, dag_id)
+
+
+def _execution_date_clause(dttm_filter):
+    """Filter on ``DagRun.execution_date`` for the given list of logical dates."""
+    # Equality on a single date lets the planner do an index seek rather than an IN-list scan
+    if len(dttm_filter) == 1:
+        return DagRun.execution_date == dttm_filter[0]
+    return DagRun.execution_date.in_(tuple(dttm_filter))
+
+
+def count_states(
+    external_dag_id: str,
+    external_task_ids: Collection[str],
+    dttm_filter,
+    allowed_states,
+    failed_states,
+    session,
+) -> Tuple[int, int]:
+    """
+    Get the count of logical dates on which the external tasks, or the external DAG
+    when ``external_task_ids`` is empty, are in ``allowed_states`` and in ``failed_states``.
+
+    :param external_dag_id: the external DAG to look at
+    :param external_task_ids: the external tasks to look at, if any
+    :param dttm_filter: date time filter for execution date
+    :param allowed_states: task or dag states counted as allowed
+    :param failed_states: task or dag states counted as failed
+    :param session: airflow session object
+    :return: tuple of allowed and failed counts; the failed count is -1
+        when no ``failed_states`` are given
+    """
+    TI = TaskInstance
+    DR = DagRun
+    if not dttm_filter:
+        return 0, (0 if failed_states else -1)
+
+    if external_task_ids:
+        # Task instances are joined to their dag run explicitly rather than through the
+        # ``execution_date`` association proxy, so that ``ti_state_lkp`` (dag_id, task_id, run_id,
+        # state) and ``dag_run_dag_id_execution_date_key`` (dag_id, execution_date) serve the query.
+        ti_filter = and_(
+            TI.dag_id == external_dag_id,
+            TI.task_id.in_(tuple(external_task_ids)),
+            DR.dag_id == external_dag_id,
+            _execution_date_clause(dttm_filter),
+        )
+
+        def count_dates_in(states):
+            # A task is only in ``states`` on a date when all of its task instances (one per
+            # map index for mapped tasks) are
+            tasks_in_states = (
+                select([DR.execution_date.label("execution_date")])
+                .select_from(join(TI, DR, TI.dag_run))
+                .where(ti_filter)
+                .group_by(DR.execution_date, TI.task_id)
+                .having(func.count() == func.sum(case([(TI.state.in_(states), 1)], else_=0)))
+                .alias()
+            )
+            # A date counts once every external task is in ``states`` on it
+            dates_in_states = (
+                select([tasks_in_states.c.execution_date])
+                .group_by(tasks_in_states.c.execution_date)
+                .having(func.count() == len(external_task_ids))
+                .alias()
+            )
+            return select([func.count()]).select_from(dates_in_states).as_scalar()
+
+        # Both buckets are scalar subqueries of a single statement, so still one round-trip
+        columns = [count_dates_in(allowed_states)]
+        if failed_states:
+            columns.append(count_dates_in(failed_states))
+        row = session.execute(select(columns)).first()
+        return int(row[0]), (int(row[1]) if failed_states else -1)
+
+    # Count each bucket with a conditional aggregate so that a single round-trip
+    # answers both "are we done?" and "did it fail?".
+    columns = [func.sum(case([(DR.state.in_(allowed_states), 1)], else_=0))]
+    if failed_states:
+        columns.append(func.sum(case([(DR.state.in_(failed_states), 1)], else_=0)))
+    # Filters follow ``dag_run_dag_id_execution_date_key`` (dag_id, execution_date)
+    stmt = select(columns).where(
+        and_(
+            DR.dag_id == external_dag_id,
+            _execution_date_clause(dttm_filter),
+            DR.state.in_((*allowed_states, *failed_states)),
+        )
+    )
+    row = session.execute(stmt).first()
+
+    # SUM() is NULL over no rows, and a DECIMAL on some backends
+    count_allowed = int(row[0] or 0)
+    count_failed = int(row[1] or 0) if failed_states else -1
+    return count_allowed, count_failed
+
 
 class ExternalTaskSensorLink(BaseOperatorLink):
     """
@@ -97,12 +295,13 @@ class ExternalTaskSensor(BaseSensorOperator):
         **kwargs,
     ):
         super().__init__(**kwargs)
-        self.allowed_states = list(allowed_states) if allowed_states else [State.SUCCESS]
-        self.failed_states = list(failed_states) if failed_states else []
+        self.allowed_states = tuple(allowed_states) if allowed_states else _DEFAULT_ALLOWED_STATES
+        self.failed_states = tuple(failed_states) if failed_states else ()
 
-        total_states = set(self.allowed_states + self.failed_states)
+        allowed_set = frozenset(self.allowed_states)
+        failed_set = frozenset(self.failed_states)
 
-        if set(self.failed_states).intersection(set(self.allowed_states)):
+        if allowed_set & failed_set:
             raise AirflowException(
                 f"Duplicate values provided as allowed "
                 f"`{self.allowed_states}` and failed states `{self.failed_states}`"
@@ -116,16 +315,20 @@ class ExternalTaskSensor(BaseSensorOperator):
 
         if external_task_id is not None:
             external_task_ids = [external_task_id]
+        if external_task_ids is not None:
+            external_task_ids = tuple(external_task_ids)
+        external_task_ids_set = frozenset(external_task_ids or ())
 
+        total_states = allowed_set | failed_set
         if external_task_ids:
-            if not total_states <= set(State.task_states):
+            if not total_states <= _TASK_STATES:
                 raise ValueError(
                     f'Valid values for `allowed_states` and `failed_states` '
                     f'when `external_task_id` or `external_task_ids` is not `None`: {State.task_states}'
                 )
-            if len(external_task_ids) > len(set(external_task_ids)):
+            if len(external_task_ids) != len(external_task_ids_set):
                 raise ValueError('Duplicate task_ids passed in external_task_ids parameter')
-        elif not total_states <= set(State.dag_states):
+        elif not total_states <= _DAG_STATES:
             raise ValueError(
                 f'Valid values for `allowed_states` and `failed_states` '
                 f'when `external_task_id` is `None`: {State.dag_states}'
@@ -139,14 +342,23 @@ class ExternalTaskSensor(BaseSensorOperator):
 
         self.execution_delta = execution_delta
         self.execution_date_fn = execution_date_fn
+        # (execution_date_fn, its make_kwargs_callable wrapper), built on first use
+        self._execution_date_kwargs_callable: Optional[Tuple[Callable, Callable]] = None
         self.external_dag_id = external_dag_id
         self.external_task_id = external_task_id
         self.external_task_ids = external_task_ids
+        self._external_task_ids_set = external_task_ids_set
         self.check_existence = check_existence
         self._has_checked_existence = False
+        # Waiting for a successful dag run, the most common use, only needs a single row lookup
+        self._fast_success = (
+            self.allowed_states == _DEFAULT_ALLOWED_STATES
+            and not self.failed_states
+            and not external_task_ids
+        )
 
-    @provide_session
-    def poke(self, context, session=None):
+    def _get_dttm_filter(self, context) -> Optional[List[datetime.datetime]]:
+        """Get the logical dates of the external DAG to look at, None if there is no date."""
         if self.execution_delta:
             dttm = context['logical_date'] - self.execution_delta
         elif self.execution_date_fn:
@@ -154,54 +366,106 @@ class ExternalTaskSensor(BaseSensorOperator):
         else:
             dttm = context['logical_date']
 
-        dttm_filter = dttm if isinstance(dttm, list) else [dttm]
-        serialized_dttm_filter = ','.join(dt.isoformat() for dt in dttm_filter)
+        if isinstance(dttm, list):
+            return dttm
+        return [dttm] if dttm is not None else None
 
-        self.log.info(
-            'Poking for tasks %s in dag %s on %s ... ',
-            self.external_task_ids,
-            self.external_dag_id,
-            serialized_dttm_filter,
-        )
+    @provide_session
+    def poke(self, context, session=None):
+        return self._poke_dates(context, self._get_dttm_filter(context), session=session)
+
+    @provide_session
+    def _poke_dates(self, context, dttm_filter, session=None) -> bool:
+        if dttm_filter is None:
+            # execution_date_fn returned no date, so there is nothing that could have succeeded
+            self.log.info('No logical date to poke for in dag %s ... ', self.external_dag_id)
+            return False
+
+        # Only serialize the dates when the message is actually going to be emitted
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info(
+                'Poking for tasks %s in dag %s on %s ... ',
+                # Formatted as a list, as external_task_ids used to be
+                list(self.external_task_ids) if self.external_task_ids is not None else None,
+                self.external_dag_id,
+                ','.join(dt.isoformat() for dt in dttm_filter),
+            )
 
         # In poke mode this will check dag existence only once
         if self.check_existence and not self._has_checked_existence:
-            self._check_for_existence(session=session)
+            self._check_for_existence(context=context, session=session)
+
+        if self._fast_success and len(dttm_filter) == 1:
+            # Not SELECT EXISTS (...), which SQL Server does not accept
+            stmt = (
+                select([DagRun.dag_id])
+                .where(
+                    and_(
+                        DagRun.dag_id == self.external_dag_id,
+                        DagRun.execution_date == dttm_filter[0],
+                        DagRun.state == State.SUCCESS,
+                    )
+                )
+                .limit(1)
+            )
+            return session.execute(stmt).first() is not None
 
-        count_allowed = self.get_count(dttm_filter, session, self.allowed_states)
+        # For an empty list of dates no query is issued: the allowed count is 0, and the
+        # failed count is 0, or -1 without failed_states
+        count_allowed, count_failed = self._get_counts(
+            dttm_filter, session, self.allowed_states, self.failed_states
+        )
 
-        count_failed = -1
-        if self.failed_states:
-            count_failed = self.get_count(dttm_filter, session, self.failed_states)
+        if count_allowed == len(dttm_filter):
+            return True
 
         if count_failed == len(dttm_filter):
-            if self.external_task_ids:
-                raise AirflowException(
-                    f'Some of the external tasks {self.external_task_ids} '
-                    f'in DAG {self.external_dag_id} failed.'
-                )
-            else:
-                raise AirflowException(f'The external DAG {self.external_dag_id} failed.')
-
-        return count_allowed == len(dttm_filter)
+            self._raise_failed()
 
-    def _check_for_existence(self, session) -> None:
-        dag_to_wait = session.query(DagModel).filter(DagModel.dag_id == self.external_dag_id).first()
+        return False
 
-        if not dag_to_wait:
+    def _raise_failed(self) -> NoReturn:
+        if self.external_task_ids:
+            raise AirflowException(
+                f'Some of the external tasks {list(self.external_task_ids)} '
+                f'in DAG {self.external_dag_id} failed.'
+            )
+        else:
+            raise AirflowException(f'The external DAG {self.external_dag_id} failed.')
+
+    def _check_for_existence(self, context, session) -> None:
+        # In reschedule mode the sensor is re-created for every poke, so the in-memory flag is
+        # always unset. A reschedule already recorded for this try means an earlier poke passed
+        # the check.
+        if (
+            self.reschedule
+            and TaskReschedule.query_for_task_instance(context['ti'], session=session).first() is not None
+        ):
+            self._has_checked_existence = True
+            return
+
+        fileloc = _get_dag_fileloc(self.external_dag_id, session)
+
+        if not fileloc:
             raise AirflowException(f'The external DAG {self.external_dag_id} does not exist.')
 
-        if not os.path.exists(dag_to_wait.fileloc):
-            raise AirflowException(f'The external DAG {self.external_dag_id} was deleted.')
+        if not _fileloc_exists(fileloc, int(time.monotonic() // _FILELOC_EXISTS_CACHE_TTL)):
+            # The cached fileloc is stale if the DAG file has been moved or renamed since
+            _dag_fileloc_cache.pop(self.external_dag_id, None)
+            fileloc = _get_dag_fileloc(self.external_dag_id, session)
+            if not fileloc:
+                raise AirflowException(f'The external DAG {self.external_dag_id} does not exist.')
+            if not _fileloc_exists(fileloc, int(time.monotonic() // _FILELOC_EXISTS_CACHE_TTL)):
+                raise AirflowException(f'The external DAG {self.external_dag_id} was deleted.')
 
         if self.external_task_ids:
-            refreshed_dag_info = DagBag(dag_to_wait.fileloc).get_dag(self.external_dag_id)
-            for external_task_id in self.external_task_ids:
-                if not refreshed_dag_info.has_task(external_task_id):
-                    raise AirflowException(
-                        f'The external task {external_task_id} in '
-                        f'DAG {self.external_dag_id} does not exist.'
-                    )
+            refreshed_dag_info = _get_external_dag(self.external_dag_id, fileloc, session)
+            missing_task_ids = self._external_task_ids_set - refreshed_dag_info.task_dict.keys()
+            if missing_task_ids:
+                raise AirflowException(
+                    f'The external task {", ".join(sorted(missing_task_ids))} in '
+                    f'DAG {self.external_dag_id} does not exist.'
+                )
         self._has_checked_existence = True
 
     def get_count(self, dttm_filter, session, states) -> int:
@@ -211,36 +475,31 @@ class ExternalTaskSensor(BaseSensorOperator):
         :param dttm_filter: date time filter for execution date
         :param session: airflow session object
         :param states: task or dag states
-        :return: count of record against the filters
+        :return: count of logical dates on which all the external tasks, or the
+            external DAG, are in ``states``
         """
-        TI = TaskInstance
-        DR = DagRun
-        if not dttm_filter:
-            return 0
+        return self._get_counts(dttm_filter, session, states, ())[0]
 
-        if self.external_task_ids:
-            count = (
-                session.query(func.count())  # .count() is inefficient
-                .filter(
-                    TI.dag_id == self.external_dag_id,
-                    TI.task_id.in_(self.external_task_ids),
-                    TI.state.in_(states),
-                    TI.execution_date.in_(dttm_filter),
-                )
-                .scalar()
-            )
-            count = count / len(self.external_task_ids)
-        else:
-            count = (
-                session.query(func.count())
-                .filter(
-                    DR.dag_id == self.external_dag_id,
-                    DR.state.in_(states),
-                    DR.execution_date.in_(dttm_filter),
-                )
-                .scalar()
-            )
-        return count
+    def _get_counts(self, dttm_filter, session, allowed_states, failed_states) -> Tuple[int, int]:
+        """
+        Get the count of records in ``allowed_states`` and in ``failed_states``
+        against dttm filter, see ``count_states``.
+
+        :param dttm_filter: date time filter for execution date
+        :param session: airflow session object
+        :param allowed_states: task or dag states counted as allowed
+        :param failed_states: task or dag states counted as failed
+        :return: tuple of allowed and failed counts; the failed count is -1
+            when no ``failed_states`` are given
+        """
+        return count_states(
+            self.external_dag_id,
+            self._external_task_ids_set,
+            dttm_filter,
+            allowed_states,
+            failed_states,
+            session,
+        )
 
     def _handle_execution_date_fn(self, context) -> Any:
         """
@@ -249,18 +508,68 @@ class ExternalTaskSensor(BaseSensorOperator):
         implementation to pass all context variables as keyword arguments, to allow
         for more sophisticated returns of dates to return.
         """
-        from airflow.utils.operator_helpers import make_kwargs_callable
-
         # Remove "logical_date" because it is already a mandatory positional argument
         logical_date = context["logical_date"]
-        kwargs = {k: v for k, v in context.items() if k not in {"execution_date", "logical_date"}}
+        kwargs = {k: v for k, v in context.items() if k not in _EXECUTION_DATE_FN_EXCLUDED_KEYS}
         # Add "context" in the kwargs for backward compatibility (because context used to be
         # an acceptable argument of execution_date_fn)
         kwargs["context"] = context
         if TYPE_CHECKING:
             assert self.execution_date_fn is not None
-        kwargs_callable = make_kwargs_callable(self.execution_date_fn)
-        return kwargs_callable(logical_date, **kwargs)
+        # Wrap again if execution_date_fn was replaced since the wrapper was built
+        cached = self._execution_date_kwargs_callable
+        if cached is None or cached[0] is not self.execution_date_fn:
+            from airflow.utils.operator_helpers import make_kwargs_callable
+
+            cached = (self.execution_date_fn, make_kwargs_callable(self.execution_date_fn))
+            self._execution_date_kwargs_callable = cached
+        return cached[1](logical_date, **kwargs)
+
+
+class ExternalTaskSensorAsync(ExternalTaskSensor):
+    """
+    Waits for a different DAG or a task in a different DAG to complete for a
+    specific logical date, deferring itself to avoid taking up a worker slot
+    while it is waiting.
+
+    It is a drop-in replacement for ExternalTaskSensor and takes the same parameters,
+    see :class:`~airflow.sensors.external_task.ExternalTaskSensor`. The external tasks
+    are checked once before deferring; the triggerer then checks them every
+    ``poke_interval`` seconds. ``mode`` is ignored, since the sensor always defers
+    rather than poking or rescheduling.
+    """
+
+    def execute(self, context: Context):
+        dttm_filter = self._get_dttm_filter(context)
+        if self._poke_dates(context, dttm_filter):
+            return
+        # The trigger enforces the sensor timeout itself, rather than a deferral timeout, so
+        # that it ends like any other sensor timeout, honouring soft_fail.
+        self.defer(
+            trigger=ExternalTaskTrigger(
+                external_dag_id=self.external_dag_id,
+                external_task_ids=list(self.external_task_ids) if self.external_task_ids else None,
+                execution_dates=dttm_filter,
+                allowed_states=list(self.allowed_states),
+                failed_states=list(self.failed_states),
+                poll_interval=self.poke_interval,
+                timeout_at=timezone.utcnow() + datetime.timedelta(seconds=self.timeout),
+            ),
+            method_name="execute_complete",
+        )
+
+    def execute_complete(self, context, event=None):
+        """Callback for when the trigger fires - raises if the external tasks failed or timed out."""
+        status = event.get("status") if event else None
+        if status == "failed":
+            self._raise_failed()
+        if status == "timeout":
+            log_dag_id = self.dag.dag_id if self.has_dag() else ""
+            # If sensor is in soft fail mode but times out raise AirflowSkipException.
+            if self.soft_fail:
+                raise AirflowSkipException(f"Snap. Time is OUT. DAG id: {log_dag_id}")
+            raise AirflowSensorTimeout(f"Snap. Time is OUT. DAG id: {log_dag_id}")
+        return None
 
 
 class ExternalTaskMarker(DummyOperator):
@@ -297,14 +606,17 @@ class ExternalTaskMarker(DummyOperator):
         super().__init__(**kwargs)
         self.external_dag_id = external_dag_id
         self.external_task_id = external_task_id
-        if isinstance(execution_date, datetime.datetime):
-            self.execution_date = execution_date.isoformat()
-        elif isinstance(execution_date, str):
-            self.execution_date = execution_date
-        else:
+        convert = _EXECUTION_DATE_CONVERTERS.get(type(execution_date))
+        if convert is None:
+            # Other subclasses of the accepted types miss the exact type lookup
+            convert = next(
+                (c for t, c in _EXECUTION_DATE_CONVERTERS.items() if isinstance(execution_date, t)), None
+            )
+        if convert is None:
             raise TypeError(
                 f'Expected str or datetime.datetime type for execution_date. Got {type(execution_date)}'
             )
+        self.execution_date = convert(execution_date)
 
         if recursion_depth <= 0:
             raise ValueError("recursion_depth should be a positive integer")
@@ -516,7 +516,7 @@ class DependencyDetector:
                 dependency_type="trigger",
                 dependency_id=task.task_id,
             )
-        elif task.task_type == "ExternalTaskSensor":
+        elif task.task_type in ("ExternalTaskSensor", "ExternalTaskSensorAsync"):
             return DagDependency(
                 source=getattr(task, "external_dag_id"),
                 target=task.dag_id,
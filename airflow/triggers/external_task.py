@@ -0,0 +1,106 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+from airflow.utils import timezone
+from airflow.utils.session import NEW_SESSION, provide_session
+
+
+class ExternalTaskTrigger(BaseTrigger):
+    """
+    A trigger that fires once the external tasks, or the external DAG when no
+    ``external_task_ids`` are given, are in one of ``allowed_states`` or in one
+    of ``failed_states`` on all of ``execution_dates``.
+
+    The metadata database is checked every ``poll_interval`` seconds. If ``timeout_at``
+    is given, the trigger fires with a ``timeout`` status once that moment has passed.
+    ``execution_dates`` of None means there is no date to look at: the trigger then never
+    succeeds and only waits for the timeout.
+    """
+
+    def __init__(
+        self,
+        external_dag_id: str,
+        external_task_ids: Optional[List[str]],
+        execution_dates: Optional[List[datetime.datetime]],
+        allowed_states: List[str],
+        failed_states: List[str],
+        poll_interval: float = 60,
+        timeout_at: Optional[datetime.datetime] = None,
+    ):
+        super().__init__()
+        self.external_dag_id = external_dag_id
+        self.external_task_ids = external_task_ids
+        self.execution_dates = execution_dates
+        self.allowed_states = allowed_states
+        self.failed_states = failed_states
+        self.poll_interval = poll_interval
+        self.timeout_at = timeout_at
+
+    def serialize(self) -> Tuple[str, Dict[str, Any]]:
+        return (
+            "airflow.triggers.external_task.ExternalTaskTrigger",
+            {
+                "external_dag_id": self.external_dag_id,
+                "external_task_ids": self.external_task_ids,
+                "execution_dates": self.execution_dates,
+                "allowed_states": self.allowed_states,
+                "failed_states": self.failed_states,
+                "poll_interval": self.poll_interval,
+                "timeout_at": self.timeout_at,
+            },
+        )
+
+    async def run(self):
+        """
+        Poll the external states until they are all allowed or all failed.
+
+        The blocking database query is run in the default executor so that it does
+        not hold up the other triggers of the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.execution_dates is not None:
+                # An empty list of dates fires on the first iteration, like poke
+                count_allowed, count_failed = await loop.run_in_executor(None, self._count_states)
+                if count_allowed == len(self.execution_dates):
+                    yield TriggerEvent({"status": "success"})
+                    return
+                if count_failed == len(self.execution_dates):
+                    yield TriggerEvent({"status": "failed"})
+                    return
+            if self.timeout_at and timezone.utcnow() >= self.timeout_at:
+                yield TriggerEvent({"status": "timeout"})
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    @provide_session
+    def _count_states(self, session=NEW_SESSION) -> Tuple[int, int]:
+        from airflow.sensors.external_task import count_states
+
+        return count_states(
+            self.external_dag_id,
+            frozenset(self.external_task_ids or ()),
+            self.execution_dates,
+            self.allowed_states,
+            self.failed_states,
+            session,
+        )